@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+_kernels.py
+
+Ahead-of-time compiled round kernel for consensus.py, for deployments
+without Numba. Build it once with Pythran (C++ with OpenMP, no JIT
+warm-up at run time):
+
+    pip install pythran
+    pythran -fopenmp _kernels.py
+
+consensus.py only picks up the compiled extension; importing this file
+as plain Python leaves the NumPy/SciPy rounds in place.
+"""
+
+
+#pythran export _step_csr(float64[:], int32[:], int32[:], int32[:], float64, float64[:])
+#pythran export _step_csr(float32[:], int32[:], int32[:], int32[:], float64, float32[:])
+#pythran export _step_csr(float64[:], int64[:], int64[:], int64[:], float64, float64[:])
+#pythran export _step_csr(float32[:], int64[:], int64[:], int64[:], float64, float32[:])
+def _step_csr(values, indptr, indices, active, alpha, out):
+    """
+    One consensus round on the CSR arrays, written into out: each active
+    agent moves by alpha towards the average of its own value and its
+    neighbors' values. The slots of isolated agents are left untouched.
+    """
+    #omp parallel for schedule(static)
+    for j in range(active.shape[0]):
+        i = active[j]
+        start = indptr[i]
+        end = indptr[i + 1]
+        v = values[i]
+        s = 0.0
+        for k in range(start, end):
+            s += values[indices[k]]
+        out[i] = v + alpha * ((v + s) / (1 + end - start) - v)
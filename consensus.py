@@ -1,111 +1,905 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-test_consensus.py
+consensus.py
 
-Tests unitaires pour le module consensus.py.
-Vérifie que les comportements requis (ajout d'agents, liens,
-simulation de consensus) fonctionnent correctement, y compris
-en conditions extrêmes.
+Distributed consensus simulation in a multi-agent system.
+Each agent holds a numerical value and repeatedly averages it with the
+values of its neighbors, until the whole network agrees on a common
+value (the global average) or a maximum number of rounds is reached.
+
+The public API works on Agent objects stored in a dict, but the
+simulation itself runs on a dense Structure-of-Arrays mirror of the
+network (one float64 array of values and a CSR adjacency) so that a
+round is a handful of vector operations instead of a Python loop.
 """
 
-import unittest
-from consensus import Agent, Network, ConsensusSimulation
-
-class TestAgent(unittest.TestCase):
-    def test_agent_creation(self):
-        ag = Agent(agent_id=5, value=10.0)
-        self.assertEqual(ag.agent_id, 5)
-        self.assertEqual(ag.value, 10.0)
-        self.assertEqual(ag.neighbors, [])
-
-    def test_agent_update_value(self):
-        ag = Agent(agent_id=10, value=0.0)
-        ag.update_value(3.14)
-        self.assertAlmostEqual(ag.value, 3.14, places=5)
-
-class TestNetwork(unittest.TestCase):
-    def setUp(self):
-        self.network = Network()
-
-    def test_add_agent(self):
-        self.network.add_agent(agent_id=1, initial_value=5.0)
-        self.assertIn(1, self.network.agents)
-        self.assertEqual(self.network.agents[1].value, 5.0)
-
-    def test_add_agent_duplicate(self):
-        self.network.add_agent(agent_id=1, initial_value=5.0)
-        with self.assertRaises(ValueError):
-            self.network.add_agent(agent_id=1, initial_value=10.0)
-
-    def test_add_edge(self):
-        self.network.add_agent(0, 10.0)
-        self.network.add_agent(1, 0.0)
-        self.network.add_edge(0, 1)
-        self.assertIn(1, self.network.agents[0].neighbors)
-        self.assertIn(0, self.network.agents[1].neighbors)
-
-    def test_add_edge_invalid(self):
-        self.network.add_agent(0, 10.0)
-        with self.assertRaises(KeyError):
-            self.network.add_edge(0, 5)  # 5 n'existe pas
-
-    def test_get_all_values(self):
-        self.network.add_agent(0, 1.2)
-        self.network.add_agent(1, 3.4)
-        vals = self.network.get_all_values()
-        self.assertEqual(vals[0], 1.2)
-        self.assertEqual(vals[1], 3.4)
-
-class TestConsensusSimulation(unittest.TestCase):
-    def setUp(self):
-        self.net = Network()
-        for i in range(4):
-            self.net.add_agent(i, float(i*10))  # 0, 10, 20, 30
-        self.net.add_edge(0, 1)
-        self.net.add_edge(1, 2)
-        self.net.add_edge(2, 3)
-
-    def test_init_invalid_step_size(self):
-        with self.assertRaises(ValueError):
-            ConsensusSimulation(self.net, step_size=1.5)
-
-    def test_run_basic(self):
-        sim = ConsensusSimulation(self.net, step_size=0.5)
-        self.assertEqual(sim.current_round, 0)
-        rounds_done = sim.run(max_rounds=100, epsilon=1e-3)
-        # Vérification qu'on a fait moins de 100 tours (on s'attend à converger avant)
-        self.assertLess(rounds_done, 100)
-
-    def test_convergence_small_network(self):
-        # Réseau en ligne : 4 agents => la moyenne des valeurs est (0 + 10 + 20 + 30)/4 = 15
-        sim = ConsensusSimulation(self.net, step_size=0.5)
-        sim.run(max_rounds=200, epsilon=1e-5)
-        final_vals = [ag.value for ag in self.net.agents.values()]
-        for val in final_vals:
-            self.assertAlmostEqual(val, 15.0, delta=0.5)  # tolérance de 0.5
-
-    def test_isolated_agent(self):
-        # Ajout d'un agent isolé (pas de voisins). Il ne bougera pas.
-        self.net.add_agent(99, 999.0)
-        sim = ConsensusSimulation(self.net, step_size=0.5)
-        sim.run(max_rounds=50, epsilon=1e-5)
-        val_isolated = self.net.agents[99].value
-        self.assertEqual(val_isolated, 999.0)  # Pas de changement
-
-    def test_has_converged_no_agents(self):
-        empty_net = Network()
-        sim = ConsensusSimulation(empty_net)
-        sim.run()
-        self.assertTrue(True, "Pas d'agents => convergence triviale, pas d'erreur.")
-
-    def test_has_converged_single_agent(self):
-        single_net = Network()
-        single_net.add_agent(0, 42.0)
-        sim = ConsensusSimulation(single_net)
-        sim.run()
-        self.assertAlmostEqual(single_net.agents[0].value, 42.0)
-        # un seul agent => déjà convergé
+from array import array
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # Numba is optional; run() then loops over the NumPy rounds.
+    numba = None
+
+try:
+    from scipy import sparse
+except ImportError:  # SciPy is optional; step() then uses np.add.reduceat.
+    sparse = None
+
+try:
+    import _kernels
+    if not hasattr(_kernels, '__pythran__'):  # plain source, not compiled
+        _kernels = None
+except ImportError:  # Optional Pythran build of _kernels.py.
+    _kernels = None
+
+
+# step() generates an unrolled round function for networks of at most
+# SPECIALIZE_MAX_AGENTS agents and SPECIALIZE_MAX_LINKS CSR entries, where
+# the call overhead of the SciPy/NumPy rounds outweighs the arithmetic.
+SPECIALIZE_MAX_AGENTS = 64
+SPECIALIZE_MAX_LINKS = 64
+
+
+class Agent:
+    """
+    An agent of the network: a unique identifier, a state value and
+    the identifiers of its neighbors.
+    """
+
+    # No per-instance __dict__: smaller agents and fixed-offset attributes.
+    # neighbors is a property over the network's edge storage, not a slot.
+    __slots__ = ('agent_id', 'value', '_network', '_pos')
+
+    def __init__(self, agent_id: int, value: float):
+        self.agent_id = agent_id
+        self.value = value
+        self._network: Optional['Network'] = None
+        self._pos = -1
+
+    @property
+    def neighbors(self) -> List[int]:
+        """
+        Identifiers of the neighbors, in increasing order (read-only copy
+        computed from the network's edge storage).
+        """
+        if self._network is None:
+            return []
+        return self._network._neighbors_of(self)
+
+    def update_value(self, new_value: float) -> None:
+        """
+        Replaces the state value of the agent, in the network's value array
+        too once it is finalized.
+        """
+        self.value = new_value
+        if self._network is not None:
+            self._network._write_value(self)
+
+
+class Network:
+    """
+    Network topology: a set of agents and bidirectional links between them.
+
+    The dense arrays used by the simulation are built by finalize(), which
+    the simulation calls lazily, and dropped whenever the topology changes.
+    Once built, the value array is the authoritative copy of the agent
+    values; it is written back to the Agent objects by get_all_values(),
+    and Agent.update_value() writes through to it.
+    """
+
+    def __init__(self):
+        self.agents: Dict[int, Agent] = {}
+        self._version = 0
+        # Counts Agent.update_value() writes to the value array, so that the
+        # simulation buffers derived from it can be refreshed.
+        self._value_writes = 0
+        # Both directions of every add_edge() call, as insertion positions
+        # of the agents; deduplicated and packed into CSR by finalize().
+        # None while a memory-mapped CSR layout is the only copy of them.
+        self._edge_src: Optional[array] = array('q')
+        self._edge_dst: Optional[array] = array('q')
+        # Neighbor identifiers per agent for neighbors reads before
+        # finalize(): built from the edge arrays on the first read, then kept
+        # up to date by add_edge().
+        self._adjacency: Optional[Dict[int, set]] = None
+        self._id_to_idx: Optional[Dict[int, int]] = None
+        self._id_of: Optional[List[int]] = None
+        self._values: Optional[np.ndarray] = None
+        self._nbr_indptr: Optional[np.ndarray] = None
+        self._nbr_indices: Optional[np.ndarray] = None
+        self._active_idx: Optional[np.ndarray] = None
+        self._spectral_bounds: Optional[Tuple[float, float]] = None
+        self._step_specialized = None
+
+    def add_agent(self, agent_id: int, initial_value: float) -> None:
+        """Adds a new agent. Raises ValueError if the identifier is taken."""
+        if agent_id in self.agents:
+            raise ValueError(f"Agent {agent_id} already exists in the network.")
+        self._invalidate()
+        agent = Agent(agent_id, initial_value)
+        agent._network = self
+        agent._pos = len(self.agents)
+        self.agents[agent_id] = agent
+
+    def add_edge(self, agent_a: int, agent_b: int) -> None:
+        """Adds a bidirectional link. Raises KeyError if an agent is unknown."""
+        for agent_id in (agent_a, agent_b):
+            if agent_id not in self.agents:
+                raise KeyError(f"Agent {agent_id} does not exist in the network.")
+        self._invalidate()
+        pos_a = self.agents[agent_a]._pos
+        pos_b = self.agents[agent_b]._pos
+        self._edge_src.extend((pos_a, pos_b))
+        self._edge_dst.extend((pos_b, pos_a))
+        if self._adjacency is not None:
+            self._adjacency.setdefault(agent_a, set()).add(agent_b)
+            self._adjacency.setdefault(agent_b, set()).add(agent_a)
+
+    def get_all_values(self) -> Dict[int, float]:
+        """Returns a dict {agent_id: value} of the current agent values."""
+        self._sync_values()
+        return {agent_id: ag.value for agent_id, ag in self.agents.items()}
+
+    def finalize(self, mmap_path: Optional[str] = None) -> None:
+        """
+        Packs the current topology into a dense value array and a CSR
+        adjacency (int32 indices). Duplicate links are merged; rows are
+        sorted by neighbor. The CSR arrays are read-only. Does nothing if already finalized, unless mmap_path is given: the arrays
+        are then rebuilt, keeping the current values.
+
+        With mmap_path, the neighbor indices (the largest array by far) are
+        written to mmap_path + '.idx' and mapped read-only from there, so
+        the OS pages them in as the rounds stream through them, and the
+        edge list is dropped (a topology change rebuilds it from the
+        mapping). The values and row offsets stay in RAM. Sorting the links
+        still takes O(nnz) memory during finalize() itself, and the SciPy
+        and NumPy rounds keep nnz-sized buffers of their own, so only the
+        Numba and Pythran kernels run with the links on disk. A later
+        rebuild after a topology change is in memory.
+        """
+        if self._values is not None:
+            if mmap_path is None:
+                return
+            self._invalidate()
+        # Dense positions follow the sorted identifiers, so the layout does
+        # not depend on the order in which agents were added.
+        ids = sorted(self.agents)
+        agents = [self.agents[agent_id] for agent_id in ids]
+        id_to_idx = {agent_id: i for i, agent_id in enumerate(ids)}
+        n = len(ids)
+
+        rank = np.empty(n, dtype=np.int64)
+        rank[[ag._pos for ag in agents]] = np.arange(n)
+        # One sort + unique pass orders the edges by source then neighbor
+        # and drops duplicates. The keys are built in place over zero-copy
+        # views of the edge arrays, to keep the int64 temporaries few.
+        src = np.frombuffer(self._edge_src, dtype=np.int64)
+        dst = np.frombuffer(self._edge_dst, dtype=np.int64)
+        keys = rank[src]
+        keys *= n
+        keys += rank[dst]
+        del src, dst  # release the buffers, so add_edge() can extend them
+        edges = np.unique(keys)
+        del keys
+        index_dtype = np.int32 if max(n, len(edges)) < 2 ** 31 else np.int64
+
+        indptr = np.zeros(n + 1, dtype=index_dtype)
+        if n:
+            np.cumsum(np.bincount(edges // n, minlength=n), out=indptr[1:])
+        if mmap_path is not None and len(edges):
+            filename = mmap_path + '.idx'
+            mapped = np.memmap(filename, dtype=index_dtype, mode='w+', shape=edges.shape)
+            np.remainder(edges, n, out=mapped, casting='unsafe')
+            mapped.flush()
+            del mapped
+            # Plain ndarray view of a read-only mapping, for the kernels.
+            indices = np.asarray(np.memmap(filename, dtype=index_dtype, mode='r',
+                                           shape=edges.shape))
+            self._edge_src = self._edge_dst = None
+        else:
+            indices = (edges % n if n else edges).astype(index_dtype)
+        indptr.flags.writeable = False
+        indices.flags.writeable = False
+
+        self._id_to_idx = id_to_idx
+        self._id_of = ids
+        self._values = np.array([ag.value for ag in agents], dtype=np.float64)
+        self._nbr_indptr = indptr
+        self._nbr_indices = indices
+        # Agents with at least one neighbor; isolated agents never change
+        # and are left out of the round loops.
+        self._active_idx = np.flatnonzero(np.diff(indptr)).astype(index_dtype)
+        self._version += 1
+
+    def spectral_bounds(self, iterations: int = 10) -> Tuple[float, float]:
+        """
+        Returns (lambda_min, lambda_max): estimates of the smallest non-zero
+        and of the largest eigenvalue of (I + D)^-1 L, the operator a round
+        subtracts (times the step size), for L = D - A the graph Laplacian.
+        lambda_max is the Gershgorin bound 2 d_max / (1 + d_max) and
+        lambda_min comes from a few power iterations on the symmetric form
+        (I + D)^-1/2 L (I + D)^-1/2 with the consensus direction projected
+        out, so both err on the large side. Cached until the topology
+        changes.
+        """
+        self.finalize()
+        if self._spectral_bounds is None:
+            n = len(self._values)
+            deg = np.diff(self._nbr_indptr).astype(np.float64)
+            d_max = float(deg.max()) if n else 0.0
+            lambda_max = 2.0 * d_max / (1.0 + d_max)
+            lambda_min = 0.0
+            if d_max:
+                rows = np.repeat(np.arange(n), np.diff(self._nbr_indptr))
+                scale = 1.0 / np.sqrt(1.0 + deg)
+                # Null direction of the symmetric form on the linked agents;
+                # isolated agents stay at zero.
+                null = np.where(deg > 0, np.sqrt(1.0 + deg), 0.0)
+                null /= np.linalg.norm(null)
+
+                def shifted(x):
+                    # (lambda_max I - S) x, whose top eigenvector is the
+                    # slowest non-consensus mode of S.
+                    y = scale * x
+                    ay = np.bincount(rows, weights=y[self._nbr_indices], minlength=n)
+                    return lambda_max * x - scale * (deg * y - ay)
+
+                x = np.random.default_rng(0).standard_normal(n) * (deg > 0)
+                for _ in range(iterations):
+                    x -= null * (null @ x)
+                    x /= np.linalg.norm(x)
+                    x = shifted(x)
+                x -= null * (null @ x)
+                x /= np.linalg.norm(x)
+                lambda_min = max(lambda_max - float(x @ shifted(x)), 0.0)
+            self._spectral_bounds = (lambda_min, lambda_max)
+        return self._spectral_bounds
+
+    def _small_step(self):
+        """
+        Returns the round function generated for this topology, building it
+        on first use, or None if the network is too large for one.
+        """
+        if (self._step_specialized is None and len(self._active_idx)
+                and len(self._values) <= SPECIALIZE_MAX_AGENTS
+                and len(self._nbr_indices) <= SPECIALIZE_MAX_LINKS):
+            self._step_specialized = self._specialize_step()
+        return self._step_specialized
+
+    def _specialize_step(self):
+        """
+        Generates, compiles and returns step(values, alpha): one round
+        unrolled over the current topology, with the neighbor indices and
+        degrees as literals, so only a straight sequence of float
+        operations is left to the interpreter. It returns the new values
+        of the active agents, in order, as a list.
+        """
+        n = len(self._values)
+        indptr = self._nbr_indptr.tolist()
+        indices = self._nbr_indices.tolist()
+        names = ', '.join(f'v{i}' for i in range(n))
+        lines = ['def step(values, alpha):',
+                 f'    {names}{"," if n == 1 else ""} = values.tolist()',
+                 '    return [']
+        for i in self._active_idx.tolist():
+            row = indices[indptr[i]:indptr[i + 1]]
+            total = ' + '.join(f'v{j}' for j in [i] + row)
+            lines.append(f'        v{i} + alpha * (({total}) / {len(row) + 1} - v{i}),')
+        lines.append('    ]')
+        namespace: Dict[str, object] = {}
+        exec(compile('\n'.join(lines), '<consensus step>', 'exec'), namespace)
+        return namespace['step']
+
+    def _neighbors_of(self, agent: Agent) -> List[int]:
+        """Sorted identifiers of the neighbors of an agent of this network."""
+        if self._nbr_indices is not None:
+            i = self._id_to_idx[agent.agent_id]
+            row = self._nbr_indices[self._nbr_indptr[i]:self._nbr_indptr[i + 1]]
+            return [self._id_of[j] for j in row.tolist()]
+        if self._adjacency is None:
+            ids = list(self.agents)
+            adjacency: Dict[int, set] = {}
+            for src, dst in zip(self._edge_src, self._edge_dst):
+                adjacency.setdefault(ids[src], set()).add(ids[dst])
+            self._adjacency = adjacency
+        return sorted(self._adjacency.get(agent.agent_id, ()))
+
+    def _write_value(self, agent: Agent) -> None:
+        """Copies the value of an agent into the value array, if built."""
+        if self._values is not None:
+            self._values[self._id_to_idx[agent.agent_id]] = agent.value
+            self._value_writes += 1
+
+    def _sync_values(self) -> None:
+        """
+        Writes the dense value array back to the Agent objects. Isolated
+        agents never change, so only the active slots are written: a
+        float32 working copy of the values would otherwise round theirs.
+        """
+        if self._values is None:
+            return
+        agents = self.agents
+        ids = self._id_of
+        active = self._active_idx
+        for i, value in zip(active.tolist(), self._values[active].tolist()):
+            agents[ids[i]].value = value
+
+    def _restore_edges(self) -> None:
+        """Rebuilds the edge arrays from the (memory-mapped) CSR arrays."""
+        pos = np.array([self.agents[agent_id]._pos for agent_id in self._id_of],
+                       dtype=np.int64)
+        self._edge_src = array('q', np.repeat(pos, np.diff(self._nbr_indptr)).tobytes())
+        self._edge_dst = array('q', pos[self._nbr_indices].tobytes())
+
+    def _invalidate(self) -> None:
+        """Drops the dense arrays after saving their values to the agents."""
+        self._sync_values()
+        if self._edge_src is None:
+            self._restore_edges()
+        self._id_to_idx = None
+        self._id_of = None
+        self._values = None
+        self._nbr_indptr = None
+        self._nbr_indices = None
+        self._active_idx = None
+        self._spectral_bounds = None
+        self._step_specialized = None
+
+
+if numba is not None:
+    # Fast-math without the no-NaN/no-Inf assumptions: the min/max
+    # reductions of the fused kernel start from +/-inf.
+    _FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+    @numba.njit(cache=True, boundscheck=False, fastmath=_FASTMATH)
+    def _agent_update(values, indptr, indices, i, alpha):
+        """New value of agent i after one round (unchanged if isolated)."""
+        start = indptr[i]
+        end = indptr[i + 1]
+        v = values[i]
+        if end == start:
+            return v
+        s = 0.0
+        for k in range(start, end):
+            s += values[indices[k]]
+        return v + alpha * ((v + s) / (1 + end - start) - v)
+
+    @numba.njit(parallel=True, cache=True, boundscheck=False, fastmath=_FASTMATH)
+    def _step_csr(values, indptr, indices, active, alpha, out):
+        """
+        One round on the CSR arrays for the active agents, written into out
+        (whose isolated slots already hold their value). Agents only read
+        their neighbors and write their own slot, so the loop is split
+        across threads in static chunks.
+        """
+        for j in numba.prange(active.shape[0]):
+            i = active[j]
+            out[i] = _agent_update(values, indptr, indices, i, alpha)
+
+    @numba.njit(parallel=True, cache=True, boundscheck=False, fastmath=_FASTMATH)
+    def _run_until_convergence(values, prev, ref, indptr, indices, active, iso_lo,
+                               iso_hi, alpha, beta, eps, max_rounds, check_every):
+        """
+        Fused rounds + convergence checks on the CSR arrays.
+
+        Each round writes the updated values of the active agents into the
+        other buffer. Every check_every rounds (and at the last one) the
+        same pass also tracks their min, max and the number of agents that
+        moved by eps or more since the values recorded in ref, so the values
+        are read and written once per round. Isolated agents never move:
+        they only enter the spread through iso_lo and iso_hi.
+        prev holds the values of the round before values (used by the
+        momentum term beta) and is overwritten by the ping-pong; on return
+        values and prev hold the last two rounds again.
+        Returns (rounds, converged).
+        """
+        n = active.shape[0]
+        cur = values
+        nxt = prev
+        rounds = 0
+        converged = False
+        for r in range(max_rounds):
+            rounds = r + 1
+            check = rounds % check_every == 0 or rounds == max_rounds
+            lo = iso_lo
+            hi = iso_hi
+            changed = 0
+            for j in numba.prange(n):
+                i = active[j]
+                v = cur[i]
+                new = _agent_update(cur, indptr, indices, i, alpha)
+                if beta != 0.0:
+                    new += beta * (v - nxt[i])
+                nxt[i] = new
+                if check:
+                    lo = min(lo, new)
+                    hi = max(hi, new)
+                    if abs(new - ref[i]) >= eps:
+                        changed += 1
+                    ref[i] = new
+            cur, nxt = nxt, cur
+            if check and (hi - lo < eps or changed == 0):
+                converged = True
+                break
+        if rounds % 2 == 1:
+            for j in numba.prange(n):
+                i = active[j]
+                v = values[i]
+                values[i] = prev[i]
+                prev[i] = v
+        return rounds, converged
+else:
+    _step_csr = None
+    _run_until_convergence = None
+
+
+# run() replaces blocks of at least DENSE_POWER_MIN_ROUNDS rounds by a
+# single product with a precomputed dense W ** k on networks with fewer
+# than DENSE_POWER_MAX_AGENTS agents.
+DENSE_POWER_MIN_ROUNDS = 32
+DENSE_POWER_MAX_AGENTS = 512
+
+
+class ConsensusSimulation:
+    """
+    Runs the consensus protocol on a network.
+
+    At each round, every agent with at least one neighbor moves its value
+    towards the average of its own value and its neighbors' values:
+        v_i <- v_i + step_size * (avg_i - v_i)
+    Isolated agents keep their value.
+
+    The rule is linear, v <- W v with W = (1 - a) I + a (I + D)^-1 (A + I),
+    so with SciPy available a round is a single sparse matrix-vector product.
+    Without Numba or Pythran, small networks use a round function generated
+    for their topology instead, built by the first step() that needs it.
+
+    step_size='auto' picks the Chebyshev-optimal 2 / (lambda_min + lambda_max)
+    from Network.spectral_bounds(), which removes the slowest modes up to
+    several times faster than 0.5. It usually exceeds 1 (overshooting
+    towards the average) but stays below 2 / lambda_max, so rounds remain
+    stable. When no gap can be estimated (no links, or a vanishing
+    estimate) it falls back to 1. The estimate is redone whenever the
+    topology changes. A numeric step_size overrides the estimate.
+
+    With momentum > 0 each agent also keeps its value of the previous round
+    (heavy-ball acceleration):
+        v_{k+1} = W v_k + momentum * (v_k - v_{k-1})
+    which cuts the number of rounds on poorly connected graphs such as
+    lines and lattices; step_size=0.9 is a good starting point there.
+
+    Values are stored with the given floating-point dtype. By default run()
+    picks float32, which halves the memory traffic of a round, unless
+    epsilon is too small for its 7 significant digits (epsilon < 1e-6 or
+    close to the float32 spacing of the values); float64 is used then.
+
+    With incremental=True each agent keeps the sum of the values its
+    neighbors last published, and an agent only republishes (adding its
+    change to its neighbors' sums) once it moved by more than
+    0.1 * epsilon; when more than half of the agents moved, the sums are
+    recomputed from scratch. Near convergence this touches the links of
+    the few agents still moving instead of every link. The neighbor values
+    used are then only accurate to that tolerance.
+
+    step_gossip() and run_gossip() offer randomized pairwise gossip as an
+    alternative: each exchange picks random links and averages the two
+    agents of each one, which costs O(1) per link instead of a full round
+    and preserves the sum of the values, so agents converge to the exact
+    global average. seed fixes the random links. current_exchange counts
+    the exchanges, separately from the rounds in current_round.
+    """
+
+    def __init__(self, network: Network, step_size: Union[float, str] = 0.5,
+                 momentum: float = 0.0, dtype=None, incremental: bool = False,
+                 seed: Optional[int] = None):
+        auto_step = isinstance(step_size, str)
+        if auto_step:
+            if step_size != 'auto':
+                raise ValueError("step_size must be in the interval (0, 1] or 'auto'.")
+        elif not 0.0 < step_size <= 1.0:
+            raise ValueError("step_size must be in the interval (0, 1] or 'auto'.")
+        if not 0.0 <= momentum < 1.0:
+            raise ValueError("momentum must be in the interval [0, 1).")
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+            if dtype not in (np.float32, np.float64):
+                raise ValueError("dtype must be float32 or float64.")
+        self.network = network
+        self._auto_step = auto_step
+        self.step_size = self._auto_step_size() if auto_step else step_size
+        self.momentum = momentum
+        self.dtype = dtype
+        self.incremental = incremental
+        self.rng = np.random.default_rng(seed)
+        self.current_round = 0
+        self.current_exchange = 0
+        self._prev_values: Optional[np.ndarray] = None
+        self._gossiped = False
+        self._publish_tol = 0.0
+        self._version = -1
+
+    def _auto_step_size(self) -> float:
+        """Returns the step size 'auto' stands for on the current topology."""
+        lambda_min, lambda_max = self.network.spectral_bounds()
+        return 2.0 / (lambda_min + lambda_max) if lambda_min > 1e-6 else 1.0
+
+    def _auto_dtype(self, epsilon: float) -> np.dtype:
+        """Returns the value dtype run() uses for this epsilon."""
+        if self.dtype is not None:
+            return self.dtype
+        values = self.network._values
+        scale = float(np.max(np.abs(values))) if values.size else 0.0
+        if epsilon < 1e-6 or epsilon < 16 * np.finfo(np.float32).eps * scale:
+            return np.dtype(np.float64)
+        return np.dtype(np.float32)
+
+    def _prepare(self, dtype=None) -> None:
+        """
+        Builds the network arrays and the per-topology buffers if needed,
+        converting the values to dtype (self.dtype, or their current dtype,
+        by default).
+        """
+        net = self.network
+        net.finalize()
+        dtype = np.dtype(dtype or self.dtype or net._values.dtype)
+        if net._values.dtype != dtype:
+            net._values = net._values.astype(dtype)
+            self._version = -1
+        if self._version == net._version:
+            return
+        self._version = net._version
+        if self._auto_step:
+            # The previous estimate may exceed 2 / lambda_max on the new links.
+            self.step_size = self._auto_step_size()
+        self._deg = np.diff(net._nbr_indptr)
+        self._has_nbrs = self._deg > 0
+        active = net._active_idx
+        # Plain slicing keeps values[active] a view when nobody is isolated.
+        self._active = slice(None) if len(active) == len(self._deg) else active
+        self._active_starts = net._nbr_indptr[:-1][active]
+        self._active_deg1 = (1 + self._deg[active]).astype(dtype)
+        self._gathered: Optional[np.ndarray] = None  # NumPy rounds only
+        self._active_sums = np.empty(len(active), dtype=dtype)
+        # Every value buffer starts as a copy: the round kernels only write
+        # the active slots, so isolated agents must already be in place.
+        self._prev_values = net._values.copy()
+        self._last_values = net._values.copy()
+        self._scratch = net._values.copy()
+        self._gossiped = False
+        self._value_writes = net._value_writes
+        self._diff = np.empty_like(net._values)
+        self._published: Optional[np.ndarray] = None
+        self._edge_rows: Optional[np.ndarray] = None
+        self._W = None
+        self._W_powers: Dict[int, np.ndarray] = {}
+
+    def _update_weights(self):
+        """
+        Returns (diag, weights): the diagonal of the update matrix W and
+        the weight of each CSR neighbor entry, for the current step size,
+        in float64. Rows of isolated agents are exactly the identity.
+        """
+        alpha = self.step_size
+        weight = np.where(self._has_nbrs, alpha / (1.0 + self._deg), 0.0)
+        diag = np.where(self._has_nbrs, 1.0 - alpha + weight, 1.0)
+        return diag, np.repeat(weight, self._deg)
+
+    def _update_matrix(self) -> 'sparse.csr_matrix':
+        """Returns the CSR update matrix W for the current step size."""
+        if self._W is None or self._W_step_size != self.step_size:
+            net = self.network
+            n = len(net._values)
+            diag, weights = self._update_weights()
+            dtype = net._values.dtype
+            adjacency = sparse.csr_matrix(
+                (weights.astype(dtype), net._nbr_indices, net._nbr_indptr),
+                shape=(n, n))
+            self._W = (adjacency + sparse.diags(diag.astype(dtype))).tocsr()
+            self._W_active = self._W[net._active_idx]
+            self._W_step_size = self.step_size
+            self._W_powers = {}
+        return self._W
+
+    def _update_matrix_power(self, rounds: int) -> np.ndarray:
+        """Returns W ** rounds as a dense array (small networks only)."""
+        if self._W_powers and self._W_powers_step_size != self.step_size:
+            self._W_powers = {}
+        if rounds not in self._W_powers:
+            net = self.network
+            n = len(net._values)
+            diag, weights = self._update_weights()
+            dense = np.diag(diag)
+            rows = np.repeat(np.arange(n), self._deg)
+            np.add.at(dense, (rows, net._nbr_indices), weights)
+            power = np.linalg.matrix_power(dense, rounds)
+            self._W_powers[rounds] = power.astype(net._values.dtype)
+            self._W_powers_step_size = self.step_size
+        return self._W_powers[rounds]
+
+    def initialize_previous_values(self) -> None:
+        """Records the current values as the reference for convergence."""
+        self._prepare()
+        np.copyto(self._prev_values, self.network._values)
+
+    def step(self) -> None:
+        """Performs one round of communication and update for all agents."""
+        self._prepare()
+        self._sync_references()
+        net = self.network
+        values = net._values
+        if values.size:
+            new = self._scratch
+            active = self._active
+            if self.incremental:
+                if self._published is None:
+                    self._published = values.copy()
+                    self._nbr_sums = self._neighbor_sums(values)
+                sums = self._active_sums
+                np.take(self._nbr_sums, net._active_idx, out=sums)
+                self._apply_sums(values, sums, new)
+            elif _step_csr is not None:
+                _step_csr(values, net._nbr_indptr, net._nbr_indices, net._active_idx,
+                          self.step_size, new)
+            elif _kernels is not None:
+                _kernels._step_csr(values, net._nbr_indptr, net._nbr_indices,
+                                   net._active_idx, self.step_size, new)
+            elif net._small_step() is not None:
+                new[active] = net._step_specialized(values, self.step_size)
+            elif sparse is not None:
+                # SciPy's matvec has no out= argument: its result for the
+                # active rows is the one allocation left per round.
+                self._update_matrix()
+                new[active] = self._W_active.dot(values)
+            else:
+                sums = self._active_sums
+                if self._gathered is None:
+                    self._gathered = np.empty(len(net._nbr_indices), dtype=values.dtype)
+                np.take(values, net._nbr_indices, out=self._gathered)
+                np.add.reduceat(self._gathered, self._active_starts, out=sums)
+                self._apply_sums(values, sums, new)
+            if self.momentum:
+                # Not in place in _last_values: it becomes the next scratch
+                # buffer, whose isolated slots must still hold their values.
+                diff = self._diff
+                np.subtract(values, self._last_values, out=diff)
+                diff *= self.momentum
+                new += diff
+            if self.incremental:
+                self._publish(new)
+            self._commit_round(new)
+        self.current_round += 1
+
+    def _apply_sums(self, values: np.ndarray, sums: np.ndarray, new: np.ndarray) -> None:
+        """
+        Writes the updated values of the active agents into new, given the
+        sums of their neighbors' values (overwritten as scratch).
+        """
+        current = values[self._active]
+        sums += current
+        sums /= self._active_deg1
+        sums -= current
+        sums *= self.step_size
+        sums += current
+        new[self._active] = sums
+
+    def _neighbor_sums(self, values: np.ndarray) -> np.ndarray:
+        """Returns the sum of the neighbors' values of every agent."""
+        net = self.network
+        sums = np.zeros_like(values)
+        sums[net._active_idx] = np.add.reduceat(values[net._nbr_indices],
+                                                self._active_starts)
+        return sums
+
+    def _publish(self, new: np.ndarray) -> None:
+        """
+        Propagates to the cached neighbor sums the change of every agent
+        that moved by more than the publishing tolerance since it last
+        published its value.
+        """
+        net = self.network
+        delta = new - self._published
+        moved = np.flatnonzero(np.abs(delta) > self._publish_tol)
+        if len(moved) > 0.5 * len(new):
+            np.copyto(self._published, new)
+            self._nbr_sums = self._neighbor_sums(new)
+        elif len(moved):
+            # CSR positions of the links of the moved agents; links are
+            # symmetric, so these are also the sums each change feeds.
+            lengths = self._deg[moved]
+            ends = np.cumsum(lengths)
+            row_shift = np.repeat(net._nbr_indptr[moved] - ends + lengths, lengths)
+            offsets = np.arange(ends[-1]) + row_shift
+            np.add.at(self._nbr_sums, net._nbr_indices[offsets],
+                      np.repeat(delta[moved], lengths))
+            self._published[moved] = new[moved]
+
+    def _sync_references(self) -> None:
+        """
+        Restarts the momentum and convergence references (and the scratch
+        buffer, for isolated agents) from the current values after gossip
+        exchanges or Agent.update_value() moved them outside the rounds.
+        Done lazily by the rounds, so that an exchange stays O(batch).
+        """
+        net = self.network
+        if self._gossiped or self._value_writes != net._value_writes:
+            values = net._values
+            np.copyto(self._last_values, values)
+            np.copyto(self._prev_values, values)
+            np.copyto(self._scratch, values)
+            self._published = None
+            self._gossiped = False
+            self._value_writes = net._value_writes
+
+    def _commit_round(self, new: np.ndarray) -> None:
+        """
+        Makes new the current values. The previous ones are kept for the
+        momentum term and the older buffer is recycled as scratch space, so
+        rounds only swap pointers between preallocated arrays.
+        """
+        if new is self._scratch:
+            self._scratch = self._last_values
+        self._last_values = self.network._values
+        self.network._values = new
+
+    def _advance(self, rounds: int) -> None:
+        """
+        Performs several rounds with no convergence check in between. Long
+        blocks on small networks without momentum apply a cached W ** rounds
+        in a single product.
+        """
+        values = self.network._values
+        if (rounds >= DENSE_POWER_MIN_ROUNDS and not self.momentum
+                and not self.incremental
+                and 0 < values.size < DENSE_POWER_MAX_AGENTS):
+            new = np.dot(self._update_matrix_power(rounds), values, out=self._scratch)
+            self._commit_round(new)
+            self.current_round += rounds
+        else:
+            for _ in range(rounds):
+                self.step()
+
+    def has_converged(self, epsilon: float) -> bool:
+        """
+        Returns True when all values lie within epsilon of each other, or
+        when no value moved by epsilon or more since the previous check.
+        """
+        self._prepare()
+        values = self.network._values
+        if values.size == 0 or np.ptp(values) < epsilon:
+            return True
+        diff = self._diff
+        np.subtract(values, self._prev_values, out=diff)
+        np.abs(diff, out=diff)
+        changed = np.count_nonzero(diff >= epsilon)
+        np.copyto(self._prev_values, values)
+        return changed == 0
+
+    def step_gossip(self, batch: int = 1) -> int:
+        """
+        Performs one gossip exchange: samples batch links uniformly at
+        random, keeps a subset in which no agent appears twice (each agent
+        goes to the first sampled link that touches it), and replaces the
+        values of both ends of every kept link by their average.
+        Returns the number of links averaged.
+        """
+        self._prepare()
+        net = self.network
+        values = net._values
+        nnz = len(net._nbr_indices)
+        src = ()
+        if self._edge_rows is None:
+            self._edge_rows = np.repeat(np.arange(len(values)), self._deg)
+        if nnz:
+            picked = self.rng.integers(0, nnz, size=batch)
+            src = self._edge_rows[picked]
+            dst = net._nbr_indices[picked]
+            if batch > 1:
+                order = np.arange(batch)
+                first = np.full(len(values), batch)
+                np.minimum.at(first, src, order)
+                np.minimum.at(first, dst, order)
+                keep = (first[src] == order) & (first[dst] == order)
+                src, dst = src[keep], dst[keep]
+            values[src] = values[dst] = 0.5 * (values[src] + values[dst])
+            self._published = None
+            self._gossiped = True
+        self.current_exchange += 1
+        return len(src)
+
+    def run_gossip(self, max_exchanges: int = 100000, epsilon: float = 1e-4,
+                   batch: int = 1) -> int:
+        """
+        Runs gossip exchanges until convergence or until max_exchanges is
+        reached. Gossip is converged when the two ends of every link are
+        within epsilon of each other: since a single exchange may leave
+        most agents untouched, "no agent moved" would stop too early. The
+        O(nnz) check runs each time as many links were averaged as there
+        are CSR entries, and after the last exchange.
+        Returns the number of exchanges performed by this call (0 when the
+        network has no links, so nothing can be averaged), like run();
+        current_exchange keeps the running total.
+        """
+        if batch < 1:
+            raise ValueError("batch must be at least 1.")
+        self.network.finalize()
+        self._prepare(self._auto_dtype(epsilon))
+        net = self.network
+        check_links = len(net._nbr_indices)
+        if not check_links:
+            return 0
+        exchanges = 0
+        links = 0
+        while exchanges < max_exchanges:
+            links += self.step_gossip(batch)
+            exchanges += 1
+            if links >= check_links or exchanges == max_exchanges:
+                links = 0
+                values = net._values
+                if np.max(np.abs(
+                        values[self._edge_rows] - values[net._nbr_indices])) < epsilon:
+                    break
+        self.network._sync_values()
+        return exchanges
+
+    def run(self, max_rounds: int = 1000, epsilon: float = 1e-4,
+            check_every: int = 8) -> int:
+        """
+        Runs rounds until convergence or until max_rounds is reached,
+        checking convergence every check_every rounds (and after the last
+        round). Returns the number of rounds performed by this call, like
+        run_gossip(); current_round keeps the running total.
+        """
+        if check_every < 1:
+            raise ValueError("check_every must be at least 1.")
+        start_round = self.current_round
+        self.network.finalize()
+        self._prepare(self._auto_dtype(epsilon))
+        self._sync_references()
+        self.initialize_previous_values()
+        # Incremental sums start fresh on every run, so drift cannot build up.
+        self._publish_tol = 0.1 * epsilon
+        self._published = None
+        if _run_until_convergence is not None and not self.incremental:
+            net = self.network
+            isolated = net._values[~self._has_nbrs]
+            iso_lo, iso_hi = ((float(isolated.min()), float(isolated.max()))
+                              if isolated.size else (np.inf, -np.inf))
+            rounds, _ = _run_until_convergence(
+                net._values, self._last_values, self._prev_values,
+                net._nbr_indptr, net._nbr_indices, net._active_idx, iso_lo, iso_hi,
+                self.step_size, self.momentum, epsilon, max_rounds, check_every)
+            self.current_round += rounds
+        else:
+            rounds_left = max_rounds
+            while rounds_left > 0:
+                block = min(check_every, rounds_left)
+                self._advance(block)
+                rounds_left -= block
+                if self.has_converged(epsilon):
+                    break
+        # Rounds outside run() use exact neighbor sums again.
+        self._publish_tol = 0.0
+        self._published = None
+        self.network._sync_values()
+        return self.current_round - start_round
+
 
 if __name__ == '__main__':
-    unittest.main()
+    net = Network()
+    net.add_agent(0, 10.0)
+    net.add_agent(1, 0.0)
+    net.add_agent(2, 20.0)
+    net.add_agent(3, 30.0)
+    net.add_edge(0, 1)
+    net.add_edge(1, 2)
+    net.add_edge(2, 3)
+
+    sim = ConsensusSimulation(net, step_size=0.5)
+    rounds_done = sim.run(max_rounds=1000, epsilon=1e-4)
+
+    print(f"Simulation completed in {rounds_done} rounds.")
+    print("Final values:", net.get_all_values())
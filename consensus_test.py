@@ -8,9 +8,27 @@ Verifies that the required behaviors (adding agents, links,
 consensus simulation) work correctly, including under extreme conditions.
 """
 
+import os
+import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
+
+import consensus
 from consensus import Agent, Network, ConsensusSimulation
 
+
+def make_line_network(n):
+    """Line network 0 - 1 - ... - (n-1) with values 0, 10, 20, ..."""
+    net = Network()
+    for i in range(n):
+        net.add_agent(i, float(i * 10))
+    for i in range(n - 1):
+        net.add_edge(i, i + 1)
+    return net
+
+
 class TestAgent(unittest.TestCase):
     def test_agent_creation(self):
         ag = Agent(agent_id=5, value=10.0)
@@ -18,6 +36,12 @@ class TestAgent(unittest.TestCase):
         self.assertEqual(ag.value, 10.0)
         self.assertEqual(ag.neighbors, [])
 
+    def test_agent_slots(self):
+        ag = Agent(agent_id=1, value=0.0)
+        self.assertFalse(hasattr(ag, '__dict__'))
+        with self.assertRaises(AttributeError):
+            ag.label = "sensor"
+
     def test_agent_update_value(self):
         ag = Agent(agent_id=10, value=0.0)
         ag.update_value(3.14)
@@ -44,6 +68,99 @@ class TestNetwork(unittest.TestCase):
         self.assertIn(1, self.network.agents[0].neighbors)
         self.assertIn(0, self.network.agents[1].neighbors)
 
+    def test_neighbors_follow_add_edge(self):
+        # Reads before finalize() are cached; later links must show up.
+        for i in range(4):
+            self.network.add_agent(i, float(i))
+        self.network.add_edge(0, 1)
+        self.assertEqual(self.network.agents[0].neighbors, [1])
+        for b in (3, 2, 1):
+            if b not in self.network.agents[0].neighbors:
+                self.network.add_edge(0, b)
+        self.assertEqual(self.network.agents[0].neighbors, [1, 2, 3])
+        self.assertEqual(self.network.agents[3].neighbors, [0])
+        self.assertEqual(len(self.network._edge_src), 6)
+
+    def test_neighbors_after_finalize(self):
+        for i in range(3):
+            self.network.add_agent(i, float(i))
+        self.network.add_edge(0, 1)
+        self.network.add_edge(0, 2)
+        self.network.finalize()
+        self.assertEqual(self.network.agents[0].neighbors, [1, 2])
+        self.assertEqual(self.network.agents[2].neighbors, [0])
+        self.assertEqual(self.network._nbr_indices.dtype, np.int32)
+        self.network.add_edge(1, 2)  # topology change drops the CSR arrays
+        self.assertEqual(self.network.agents[2].neighbors, [0, 1])
+
+    def test_finalize_dense_order(self):
+        for agent_id, value in [(7, 1.0), (2, 2.0), (5, 3.0)]:
+            self.network.add_agent(agent_id, value)
+        self.network.add_edge(7, 2)
+        self.network.finalize()
+        self.assertEqual(self.network._id_of, [2, 5, 7])
+        self.assertEqual(self.network._values.tolist(), [2.0, 3.0, 1.0])
+        self.assertEqual(self.network.agents[7].neighbors, [2])
+
+    def test_add_edge_duplicate(self):
+        # Repeated links are merged and do not bias the neighbor average.
+        for i in range(3):
+            self.network.add_agent(i, float(i * 10))
+        self.network.add_edge(0, 1)
+        self.network.add_edge(1, 0)
+        self.network.add_edge(1, 2)
+        self.assertEqual(self.network.agents[1].neighbors, [0, 2])
+        self.network.finalize()
+        self.assertEqual(self.network.agents[1].neighbors, [0, 2])
+        self.assertEqual(self.network._nbr_indptr.tolist(), [0, 1, 3, 4])
+        sim = ConsensusSimulation(self.network, step_size=1.0, dtype=np.float64)
+        sim.step()
+        self.assertAlmostEqual(self.network.get_all_values()[1], 10.0)
+
+    def test_finalize_mmap(self):
+        for i in range(4):
+            self.network.add_agent(i, float(i * 10))
+        for a, b in [(0, 1), (1, 2), (2, 3)]:
+            self.network.add_edge(a, b)
+        self.network.finalize()  # in RAM first
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "line")
+            self.network.finalize(mmap_path=path)  # rebuilt onto the mapping
+            self.assertTrue(os.path.exists(path + ".idx"))
+            self.assertFalse(self.network._nbr_indices.flags.writeable)
+            self.assertIsNone(self.network._edge_src)  # the mapping holds the links
+            self.assertEqual(self.network.agents[1].neighbors, [0, 2])
+            sim = ConsensusSimulation(self.network, step_size=0.5)
+            rounds_done = sim.run(max_rounds=1000, epsilon=1e-4)
+            reference = make_line_network(4)
+            self.assertEqual(rounds_done, ConsensusSimulation(reference, step_size=0.5).run(
+                max_rounds=1000, epsilon=1e-4))
+            expected = reference.get_all_values()
+            for agent_id, val in self.network.get_all_values().items():
+                self.assertAlmostEqual(val, expected[agent_id], places=6)
+            # Rebuilt from the mapping, which is released before the
+            # directory is removed.
+            self.network.add_agent(4, 0.0)
+            self.network.add_edge(3, 4)
+            del sim
+            self.assertEqual(len(self.network._edge_src), 8)
+            self.assertEqual(self.network.agents[3].neighbors, [2, 4])
+            self.assertEqual(self.network.agents[0].neighbors, [1])
+
+    def test_specialized_step(self):
+        net = make_line_network(3)
+        net.add_agent(3, 7.0)  # isolated: left out of the result
+        net.finalize()
+        self.assertIsNone(net._step_specialized)  # generated on first use only
+        step = net._small_step()
+        self.assertIsNotNone(step)
+        # 0 + 0.5 * (5 - 0), 10 + 0.5 * (10 - 10), 20 + 0.5 * (15 - 20)
+        np.testing.assert_allclose(step(net._values, 0.5), [2.5, 10.0, 17.5])
+
+        large = make_line_network(100)
+        large.finalize()
+        self.assertIsNone(large._small_step())
+
     def test_add_edge_invalid(self):
         self.network.add_agent(0, 10.0)
         with self.assertRaises(KeyError):
@@ -75,6 +192,10 @@ class TestConsensusSimulation(unittest.TestCase):
         rounds_done = sim.run(max_rounds=100, epsilon=1e-3)
         # Verify that we did less than 100 rounds (expect to converge before)
         self.assertLess(rounds_done, 100)
+        # Counts are per call; current_round keeps the total.
+        more = sim.run(max_rounds=100, epsilon=1e-3)
+        self.assertLessEqual(more, 8)
+        self.assertEqual(sim.current_round, rounds_done + more)
 
     def test_convergence_small_network(self):
         # Line network: 4 agents => the average value is (0 + 10 + 20 + 30)/4 = 15
@@ -92,6 +213,33 @@ class TestConsensusSimulation(unittest.TestCase):
         val_isolated = self.net.agents[99].value
         self.assertEqual(val_isolated, 999.0)  # No change
 
+    def test_isolated_agent_keeps_exact_value(self):
+        # 0.1 is not a float32 value: the default float32 rounds must not round it.
+        self.net.add_agent(99, 0.1)
+        sim = ConsensusSimulation(self.net, step_size=0.5)
+        sim.run(max_rounds=50, epsilon=1e-3)
+        self.assertEqual(self.net._values.dtype, np.float32)
+        self.assertEqual(self.net.get_all_values()[99], 0.1)
+        single_net = Network()
+        single_net.add_agent(0, 0.1)
+        ConsensusSimulation(single_net).run(epsilon=1e-3)
+        self.assertEqual(single_net.get_all_values()[0], 0.1)
+
+    def test_isolated_agents_skipped(self):
+        # Isolated agents are left out of the rounds without changing the others.
+        for agent_id in (-5, 50, 99):
+            self.net.add_agent(agent_id, float(agent_id))
+        sim = ConsensusSimulation(self.net, step_size=0.5, dtype=np.float64)
+        rounds_done = sim.run(max_rounds=500, epsilon=1e-6, check_every=1)
+        reference = make_line_network(4)
+        expected_rounds = ConsensusSimulation(reference, step_size=0.5, dtype=np.float64).run(
+            max_rounds=500, epsilon=1e-6, check_every=1)
+        self.assertEqual(rounds_done, expected_rounds)
+        vals = self.net.get_all_values()
+        for agent_id, val in reference.get_all_values().items():
+            self.assertAlmostEqual(vals[agent_id], val, places=9)
+        self.assertEqual([vals[-5], vals[50], vals[99]], [-5.0, 50.0, 99.0])
+
     def test_has_converged_no_agents(self):
         empty_net = Network()
         sim = ConsensusSimulation(empty_net)
@@ -106,5 +254,250 @@ class TestConsensusSimulation(unittest.TestCase):
         self.assertAlmostEqual(single_net.agents[0].value, 42.0)
         # single agent => already converged
 
+    def test_step_matches_neighbor_average(self):
+        # One round computed by hand: v_i + 0.5 * ((v_i + sum(neighbors)) / (1 + deg) - v_i)
+        sim = ConsensusSimulation(self.net, step_size=0.5)
+        sim.step()
+        vals = self.net.get_all_values()
+        self.assertAlmostEqual(vals[0], 2.5)
+        self.assertAlmostEqual(vals[1], 10.0)
+        self.assertAlmostEqual(vals[2], 20.0)
+        self.assertAlmostEqual(vals[3], 27.5)
+
+    def test_has_converged_tracks_changes(self):
+        sim = ConsensusSimulation(self.net, step_size=0.5)
+        sim.initialize_previous_values()
+        self.assertTrue(sim.has_converged(epsilon=1e-3))  # nothing moved yet
+        sim.step()
+        self.assertFalse(sim.has_converged(epsilon=1e-3))
+        self.assertTrue(sim.has_converged(epsilon=1e-3))  # reference was updated
+        self.assertTrue(sim.has_converged(epsilon=100.0))  # spread below epsilon
+
+    def test_run_matches_manual_rounds(self):
+        # run() may use a fused kernel; it must agree with step() + has_converged().
+        for momentum in (0.0, 0.5):
+            with self.subTest(momentum=momentum):
+                net, other = make_line_network(4), make_line_network(4)
+                manual = ConsensusSimulation(other, step_size=0.5, momentum=momentum,
+                                             dtype=np.float64)
+                manual.initialize_previous_values()
+                manual.step()
+                while not manual.has_converged(epsilon=1e-4):
+                    manual.step()
+                sim = ConsensusSimulation(net, step_size=0.5, momentum=momentum,
+                                          dtype=np.float64)
+                self.assertEqual(sim.run(epsilon=1e-4, check_every=1), manual.current_round)
+                expected = other.get_all_values()
+                for agent_id, val in net.get_all_values().items():
+                    self.assertAlmostEqual(val, expected[agent_id], places=9)
+
+    def test_run_check_every(self):
+        sim = ConsensusSimulation(self.net, step_size=0.5)
+        self.assertEqual(sim.run(max_rounds=1000, epsilon=1e-4, check_every=8) % 8, 0)
+        sim = ConsensusSimulation(make_line_network(4), step_size=0.5)
+        self.assertEqual(sim.run(max_rounds=20, epsilon=1e-12, check_every=8), 20)
+        with self.assertRaises(ValueError):
+            sim.run(check_every=0)
+
+    def test_long_blocks_match_single_rounds(self):
+        # Blocks of 32+ rounds may be applied as one dense W ** k product.
+        self.net.add_agent(99, 0.1)
+        block = ConsensusSimulation(self.net, step_size=0.5)
+        block.run(max_rounds=64, epsilon=1e-12, check_every=32)
+        other = make_line_network(4)
+        other.add_agent(99, 0.1)
+        single = ConsensusSimulation(other, step_size=0.5)
+        for _ in range(64):
+            single.step()
+        expected = other.get_all_values()
+        for agent_id, val in self.net.get_all_values().items():
+            self.assertAlmostEqual(val, expected[agent_id], places=9)
+        self.assertEqual(self.net.agents[99].value, 0.1)
+
+    def test_value_dtype(self):
+        sim = ConsensusSimulation(self.net, step_size=0.5)
+        sim.run(epsilon=1e-3)
+        self.assertEqual(self.net._values.dtype, np.float32)
+        sim.run(epsilon=1e-8)  # too fine for float32
+        self.assertEqual(self.net._values.dtype, np.float64)
+        for val in self.net.get_all_values().values():
+            self.assertIsInstance(val, float)
+        sim = ConsensusSimulation(make_line_network(4), dtype=np.float32)
+        sim.step()
+        self.assertEqual(sim.network._values.dtype, np.float32)
+        with self.assertRaises(ValueError):
+            ConsensusSimulation(self.net, dtype=np.int64)
+
+    def test_step_reuses_buffers(self):
+        sim = ConsensusSimulation(self.net, step_size=0.5, momentum=0.3)
+        sim.step()
+        buffers = {id(self.net._values), id(sim._last_values), id(sim._scratch)}
+        for _ in range(5):
+            sim.step()
+            self.assertIn(id(self.net._values), buffers)
+        self.assertEqual(len({id(self.net._values), id(sim._last_values), id(sim._scratch)}), 3)
+
+    def test_incremental_matches_full_rounds(self):
+        # A settled component next to a moving one: only a few agents republish.
+        nets = []
+        for _ in range(2):
+            net = make_line_network(4)
+            for i in range(10, 20):
+                net.add_agent(i, 5.0)
+                if i > 10:
+                    net.add_edge(i - 1, i)
+            nets.append(net)
+        full = ConsensusSimulation(nets[0], step_size=0.5, dtype=np.float64)
+        incremental = ConsensusSimulation(nets[1], step_size=0.5, dtype=np.float64,
+                                          incremental=True)
+        for _ in range(20):
+            full.step()
+            incremental.step()
+        expected = nets[0].get_all_values()
+        for agent_id, val in nets[1].get_all_values().items():
+            self.assertAlmostEqual(val, expected[agent_id], places=9)
+        full.run(max_rounds=1000, epsilon=1e-4, check_every=1)
+        incremental.run(max_rounds=1000, epsilon=1e-4, check_every=1)
+        expected = nets[0].get_all_values()
+        for agent_id, val in nets[1].get_all_values().items():
+            self.assertAlmostEqual(val, expected[agent_id], delta=1e-3)
+        # Back to exact sums after run(): one more round on equal values agrees.
+        np.copyto(nets[0]._values, nets[1]._values)
+        full.step()
+        incremental.step()
+        self.assertEqual(incremental._publish_tol, 0.0)
+        np.testing.assert_allclose(nets[1]._values, nets[0]._values, rtol=0, atol=1e-12)
+
+    def test_gossip_reaches_average(self):
+        # Pairwise averaging preserves the sum: agents meet at the exact average.
+        for batch in (1, 4):
+            with self.subTest(batch=batch):
+                net = make_line_network(4)
+                sim = ConsensusSimulation(net, seed=0, dtype=np.float64)
+                exchanges = sim.run_gossip(max_exchanges=10000, epsilon=1e-6, batch=batch)
+                self.assertLess(exchanges, 10000)
+                vals = list(net.get_all_values().values())
+                self.assertAlmostEqual(sum(vals), 60.0, places=9)
+                for val in vals:
+                    self.assertAlmostEqual(val, 15.0, delta=1e-4)
+
+    def test_gossip_without_links(self):
+        self.assertEqual(ConsensusSimulation(Network()).run_gossip(), 0)
+        lone = Network()
+        lone.add_agent(0, 1.0)
+        self.assertEqual(ConsensusSimulation(lone).run_gossip(), 0)
+        self.net.add_agent(99, 999.0)
+        sim = ConsensusSimulation(self.net, seed=1)
+        self.assertEqual(sim.step_gossip(batch=1), 1)
+        self.assertEqual(self.net.get_all_values()[99], 999.0)
+        with self.assertRaises(ValueError):
+            sim.run_gossip(batch=0)
+
+    def test_gossip_then_rounds(self):
+        sim = ConsensusSimulation(self.net, step_size=0.5, momentum=0.5, seed=0,
+                                  dtype=np.float64)
+        exchanges = sim.run_gossip(max_exchanges=5)
+        self.assertEqual(sim.current_exchange, exchanges)
+        self.assertEqual(sim.current_round, 0)
+        # The first round after gossip has no momentum term yet.
+        reference = make_line_network(4)
+        for agent_id, val in self.net.get_all_values().items():
+            reference.agents[agent_id].update_value(val)
+        ConsensusSimulation(reference, step_size=0.5, dtype=np.float64).step()
+        sim.step()
+        self.assertEqual(sim.current_round, 1)
+        expected = reference.get_all_values()
+        for agent_id, val in self.net.get_all_values().items():
+            self.assertAlmostEqual(val, expected[agent_id], places=12)
+
+    def test_auto_step_size(self):
+        lambda_min, lambda_max = self.net.spectral_bounds()
+        self.assertAlmostEqual(lambda_max, 4.0 / 3.0)
+        self.assertAlmostEqual(lambda_min, 0.2713, places=3)
+        sim = ConsensusSimulation(make_line_network(20), step_size='auto')
+        self.assertTrue(1.0 < sim.step_size < 2.0 / lambda_max)
+        plain = ConsensusSimulation(make_line_network(20), step_size=0.5)
+        self.assertLess(sim.run(max_rounds=5000), plain.run(max_rounds=5000))
+        # Links that raise the max degree: the estimate follows the topology.
+        net = make_line_network(20)
+        sim = ConsensusSimulation(net, step_size='auto')
+        first = sim.step_size
+        for i in range(0, 18, 2):
+            net.add_edge(i, i + 3)
+        sim.run(max_rounds=200)
+        self.assertLess(sim.step_size, first)
+        self.assertAlmostEqual(sim.step_size,
+                               ConsensusSimulation(net, step_size='auto').step_size)
+        vals = list(net.get_all_values().values())
+        self.assertLess(max(vals) - min(vals), 1.0)  # 190 at the start; diverged before
+        # No links: no gap to estimate.
+        isolated = Network()
+        isolated.add_agent(0, 1.0)
+        self.assertEqual(isolated.spectral_bounds(), (0.0, 0.0))
+        self.assertEqual(ConsensusSimulation(isolated, step_size='auto').step_size, 1.0)
+        self.assertEqual(ConsensusSimulation(Network(), step_size='auto').step_size, 1.0)
+        with self.assertRaises(ValueError):
+            ConsensusSimulation(self.net, step_size='fast')
+
+    def test_init_invalid_momentum(self):
+        with self.assertRaises(ValueError):
+            ConsensusSimulation(self.net, momentum=1.0)
+
+    def test_momentum_reduces_rounds(self):
+        plain = ConsensusSimulation(make_line_network(20), step_size=0.9)
+        accelerated = ConsensusSimulation(make_line_network(20), step_size=0.9, momentum=0.7)
+        self.assertLess(accelerated.run(max_rounds=5000), plain.run(max_rounds=5000))
+
+    def test_step_isolated_agent_exact(self):
+        self.net.add_agent(99, 0.1)
+        sim = ConsensusSimulation(self.net, step_size=0.3)
+        for _ in range(5):
+            sim.step()
+        self.assertEqual(self.net.get_all_values()[99], 0.1)
+
+    def test_momentum_isolated_agent_exact(self):
+        # Checked in the value array: isolated agents are not written back.
+        def isolated_value(net):
+            return net._values[net._id_to_idx[99]]
+
+        self.net.add_agent(99, 999.0)
+        sim = ConsensusSimulation(self.net, step_size=0.5, momentum=0.5)
+        for _ in range(5):
+            sim.step()
+            self.assertEqual(isolated_value(self.net), 999.0)
+        # The same through the per-round loop run() uses without Numba.
+        for fused in (consensus._run_until_convergence, None):
+            with self.subTest(fused=fused is not None), \
+                    mock.patch.object(consensus, '_run_until_convergence', fused):
+                net = make_line_network(4)
+                net.add_agent(99, 999.0)
+                ConsensusSimulation(net, step_size=0.9, momentum=0.5).run(max_rounds=200)
+                self.assertEqual(isolated_value(net), 999.0)
+
+    def test_update_value_after_finalize(self):
+        self.net.add_agent(99, 1.0)
+        sim = ConsensusSimulation(self.net, step_size=0.5, momentum=0.5, dtype=np.float64)
+        sim.step()  # 2.5, 10, 17.5, 27.5
+        self.net.agents[0].update_value(1000.0)
+        self.net.agents[99].update_value(5.0)
+        sim.step()
+        vals = self.net.get_all_values()
+        # No momentum term from the overwritten value.
+        self.assertAlmostEqual(vals[0], 1000.0 + 0.5 * ((1000.0 + 10.0) / 2 - 1000.0))
+        for _ in range(3):
+            sim.step()
+        self.assertEqual(self.net._values[self.net._id_to_idx[99]], 5.0)
+        self.assertEqual(self.net.get_all_values()[99], 5.0)
+
+    def test_topology_change_keeps_values(self):
+        sim = ConsensusSimulation(self.net, step_size=0.5)
+        sim.step()
+        self.net.add_agent(4, 100.0)
+        self.net.add_edge(3, 4)
+        self.assertAlmostEqual(self.net.agents[3].value, 27.5)
+        sim.step()
+        vals = self.net.get_all_values()
+        self.assertAlmostEqual(vals[4], 100.0 + 0.5 * ((100.0 + 27.5) / 2 - 100.0))
+
 if __name__ == '__main__':
     unittest.main()